@@ -1,8 +1,46 @@
 import streamlit as st
 from yt_dlp import YoutubeDL
+from yt_dlp.version import __version__ as _YTDLP_VERSION
+from concurrent.futures import Future
+from functools import lru_cache
+import asyncio
+import atexit
+import random
+import re
+import shutil
 import tempfile
+import threading
+import time
+import zipfile
 import os
-import glob
+
+# YouTube URLの判定用正規表現（モジュール読み込み時に一度だけコンパイル）
+# プレフィックス比較と違い、m./music.のサブドメインやshorts/再生リストも受け付けつつ、
+# 動画ID部分が空のURLは弾ける
+_YT_RE = re.compile(
+    r'^https?://'
+    r'(?:(?:www\.|m\.|music\.)?youtube\.com/(?:watch\?v=|shorts/|playlist\?list=)'
+    r'|youtu\.be/)'
+    r'[\w\-]+')
+
+# URLがYouTubeのものかどうかを判定する関数
+# （Streamlitは操作のたびにスクリプトを再実行するため、同じURLの判定結果はキャッシュする）
+@lru_cache(maxsize=256)
+def validate_url(url):
+    return bool(_YT_RE.match(url))
+
+# 短縮URL（youtu.be）から動画IDを取り出すための正規表現（モジュール読み込み時に一度だけコンパイル）
+_SHORT_URL_RE = re.compile(r'https://youtu\.be/([\w-]+)')
+
+# 短縮URLを標準のwatch形式に正規化する関数
+def normalize_url(url):
+    # 正規表現に触れる前に部分文字列チェックで早期リターンする
+    if 'youtu.be/' not in url:
+        return url
+    m = _SHORT_URL_RE.search(url)
+    if m:
+        return f"https://www.youtube.com/watch?v={m.group(1)}"
+    return url
 
 # Streamlitのウェブインターフェース
 def main():
@@ -11,54 +49,328 @@ def main():
     # ラジオボタンで処理モードを切り替える
     ope_mode = st.radio("処理モードを選択してください：", ["音声のみ", "映像"])
 
-    # YouTubeのURLを入力するテキストボックス
-    yt_url = st.text_input("YouTubeのURL : ")
+    # YouTubeのURLを入力するテキストボックス（1行に1件、複数指定可）
+    yt_url = st.text_area("YouTubeのURL（1行に1件） : ")
+
+    # サイドバーからyt-dlpのキャッシュを削除できるようにする
+    if st.sidebar.button("キャッシュをクリア"):
+        clear_cache()
+
+    # フラグメントの並列ダウンロード数（回線が細い環境では下げられるようにする）
+    n_frags = st.sidebar.slider("並列ダウンロード数", 1, 8, 4)
+
+    # 音声をmp3へ変換せず、元の形式（m4aなど）のまま保存するオプション
+    # （変換を省略できるためダウンロード完了までが速い）
+    native_audio = st.sidebar.checkbox("音声を元の形式のまま保存")
+
+    # デバッグモード（オンのときだけ参考情報を表示する）
+    st.sidebar.checkbox("デバッグモード", key='debug_mode')
 
     # ダウンロードボタン
     if st.button("ダウンロード"):
-        download_video(yt_url, ope_mode)
+        urls = [u.strip() for u in yt_url.splitlines() if u.strip()]
+        if urls and all(validate_url(u) for u in urls):
+            download_video(urls, ope_mode, n_frags, native_audio)
+        else:
+            st.error("YouTubeのURLを入力してください。")
+
+# aria2cが使える環境なら多重接続ダウンロードに切り替える（検出はインポート時に一度だけ）
+_ARIA2 = shutil.which('aria2c')
+
+# yt-dlpのキャッシュ置き場（パス解決はインポート時に一度だけ行う）
+# 明示しておくことで、コンテナが再起動してもホームが永続する環境なら
+# player JSの取得とシグネチャ解読のキャッシュが引き継がれる
+_YTDLP_CACHE_DIR = os.path.expanduser('~/.cache/yt-dlp')
+_CACHE_DIRS = (
+    _YTDLP_CACHE_DIR,
+    os.path.expanduser('~/.cache/youtube-dl'),
+)
+
+# yt-dlpのキャッシュを削除する関数
+def clear_cache():
+    for d in _CACHE_DIRS:
+        if os.path.isdir(d):
+            shutil.rmtree(d, ignore_errors=True)
+            st.info(f"キャッシュをクリアしました: {d}")
+
+# tmpfs（RAM上のファイルシステム）が使えるか（判定はインポート時に一度だけ行う）
+_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# セッション専用のダウンロード先ディレクトリを取得する関数
+# （プロセス終了時にまとめて削除されるため、ファイルを丸ごとメモリに読み込む必要がない。
+#   見込みサイズがtmpfsの空きに収まる場合はRAM上に置き、ディスクI/Oを丸ごと省く）
+def get_download_dir(size_hint=0):
+    base = None
+    if _SHM_DIR and size_hint:
+        # 後処理の中間ファイル分も見込んで2倍で見積もり、溢れそうならディスクに退避する
+        if size_hint * 2 < shutil.disk_usage(_SHM_DIR).free:
+            base = _SHM_DIR
+    dirs = st.session_state.setdefault('dl_dirs', {})
+    if base not in dirs:
+        dl_dir = tempfile.mkdtemp(prefix='yt_dl_', dir=base)
+        atexit.register(shutil.rmtree, dl_dir, ignore_errors=True)
+        dirs[base] = dl_dir
+    return dirs[base]
+
+# 指定したURL（複数可）をダウンロードする関数
+def download_video(yt_urls, ope_mode, n_frags=4, native_audio=False):
+    # 途中経過はメッセージを積み上げず、1つのst.statusコンテナをその場で更新する
+    with st.status("ダウンロード中...") as status:
+        try:
+            # YoutubeDLインスタンスはキャッシュ済みなので、複数件でも初期化コストは1回分
+            results = [download_video_content(url, ope_mode, n_frags, native_audio)
+                       for url in yt_urls]
+            status.update(label="ダウンロードが完了しました！", state="complete")
+        except Exception as e:
+            results = None
+            st.error(f"エラーが発生しました: {e}")
+            status.update(label="ダウンロードに失敗しました。", state="error")
+    if results:
+        if len(results) == 1:
+            file_path, file_name = results[0]
+        else:
+            # 複数件は1つのZIPにまとめる
+            # （mp4/mp3は圧縮済みのため、再圧縮しないZIP_STOREDで固める）
+            file_path = os.path.join(get_download_dir(), 'download.zip')
+            file_name = 'download.zip'
+            with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_STORED) as zf:
+                for path, name in results:
+                    zf.write(path, name)
+        # StreamlitはBufferedReaderを受け取り、内容をメディアファイルマネージャへ
+        # コピーして配信するため、openしたままのハンドルを渡す（withで閉じない）
+        data = open(file_path, "rb")
+        st.download_button(
+            label="ファイルをダウンロード",
+            data=data,
+            file_name=file_name,
+            mime="application/octet-stream"
+        )
+        st.success("ダウンロードが完了しました！ファイルをダウンロードボタンから保存してください。")
+
+# 進捗の共有状態（キャッシュされたYoutubeDLにフックを登録するためモジュールレベルで持つ）
+_progress_state = {'value': 0.0}
+
+# yt-dlpの進捗フック
+# （ワーカースレッドから呼ばれるためStreamlitには触れず、進捗値の記録だけを行う）
+def _progress_hook(d):
+    if d['status'] != 'downloading':
+        return
+    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+    if total:
+        _progress_state['value'] = min(d['downloaded_bytes'] / total, 1.0)
+
+# ダウンロード本体をワーカースレッドで実行する関数
+# （スクリプトスレッドを塞がないため、長い動画でもwebsocketのハートビートが途切れない）
+def _run_download(yt, info):
+    async def _run():
+        bar = st.progress(0.0)
+        task = asyncio.ensure_future(
+            asyncio.to_thread(yt.process_ie_result, info, download=True))
+        # 完了までメインスレッド側で進捗を描画する（更新は最大10回/秒）
+        while not task.done():
+            bar.progress(_progress_state['value'])
+            await asyncio.sleep(0.1)
+        bar.progress(1.0)
+        return task.result()
+
+    _progress_state['value'] = 0.0
+    return asyncio.run(_run())
 
-# 指定したURLをダウンロードする関数
-def download_video(yt_url, ope_mode):
+# 処理モードと並列数ごとにYoutubeDLインスタンスを使い回す関数
+# （毎回生成するとextractor初期化などで数百msかかるため、st.cache_resourceで保持する）
+@st.cache_resource
+def get_ydl(ope_mode, n_frags=4, need_convert=True):
     yt_opt = get_download_options(ope_mode)
-    temp_dir = tempfile.mkdtemp()
-    yt_opt['outtmpl'] = temp_dir + '/downloaded_file.%(ext)s'
+    yt_opt['concurrent_fragment_downloads'] = n_frags
+    if not need_convert:
+        # 入力が既に目的の形式ならffmpegの変換パスを丸ごと外す
+        yt_opt.pop('postprocessors', None)
+        yt_opt.pop('postprocessor_args', None)
+    yt = YoutubeDL(yt_opt)
+    # インスタンスはセッション間で共有されるため、outtmplの差し替えを伴う
+    # ダウンロードはこのロックで直列化する
+    yt.outtmpl_lock = threading.Lock()
+    return yt
 
+# 動画のメタデータ取得結果をキャッシュする関数
+# （同じURLを再ダウンロードするときにページ取得とplayer JSの解析をやり直さない）
+@st.cache_data(ttl=1800, show_spinner=False)
+def get_info(url, ope_mode, n_frags=4):
+    yt = get_ydl(ope_mode, n_frags)
+    return yt.sanitize_info(yt.extract_info(url, download=False))
+
+# ダウンロード全体の最大試行回数
+_MAX_ATTEMPTS = 3
+
+# ダウンロード済みファイルをキャッシュとして保持する秒数
+_PAYLOAD_TTL = 3600
+
+# 実行中ダウンロードの共有テーブル
+# （st.cache_dataはセッションをまたぐ同時リクエストを直列化しないため、
+#   同じ動画への同時クリックはここで1回の実処理にまとめる）
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+# 動画をダウンロードしてファイルのパスと名前を返す関数
+# （同じ(URL, モード)の再実行はyt-dlp/ffmpegを起動し直さずキャッシュ済みのパスを返す。
+#   失敗は例外で抜けるため、結果としてキャッシュに残らない）
+@st.cache_data(ttl=_PAYLOAD_TTL, max_entries=8, show_spinner=False)
+def download_video_content(yt_url, ope_mode, n_frags=4, native_audio=False):
+    key = (yt_url, ope_mode, n_frags, native_audio)
+    with _INFLIGHT_LOCK:
+        fut = _INFLIGHT.get(key)
+        if fut is None:
+            fut = _INFLIGHT[key] = Future()
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        # 別セッションが同じダウンロードを実行中なので、完了を待って結果を共有する
+        return fut.result()
     try:
-        with YoutubeDL(yt_opt) as yt:
-            yt.download([yt_url])
-            # ダウンロードされたファイルを検索
-            downloaded_files = glob.glob(temp_dir + '/*')
-            if downloaded_files:
-                # 最初のダウンロードされたファイルを選択
-                filepath = downloaded_files[0]
-                with open(filepath, "rb") as file:
-                    st.download_button(
-                        label="ファイルをダウンロード",
-                        data=file,
-                        file_name=os.path.basename(filepath),
-                        mime="application/octet-stream"
-                    )
-                st.success("ダウンロードが完了しました！ファイルをダウンロードボタンから保存してください。")
-            else:
-                st.error("ダウンロードされたファイルが見つかりません。")
-    except Exception as e:
-        st.error(f"エラーが発生しました: {e}")
+        result = _do_download(yt_url, ope_mode, n_frags, native_audio)
+        fut.set_result(result)
+        return result
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
 
-# ダウンロードオプションを取得する関数
-def get_download_options(ope_mode):
+# ダウンロード処理の本体（download_video_contentのキャッシュ・重複排除層から呼ばれる）
+def _do_download(yt_url, ope_mode, n_frags, native_audio):
+    # デバッグモードでなければ参考情報のログを完全なno-opにする
+    # （st.infoは1回ごとにwebsocketフレームの送信と再描画を伴う）
+    _info = st.info if st.session_state.get('debug_mode') else (lambda *a, **k: None)
+    _info(f"yt-dlpバージョン: {_YTDLP_VERSION}")
+
+    yt_url = normalize_url(yt_url)
+
+    # メタデータから変換の要否を判定し、不要ならffmpegを一度も起動しない
+    probe = get_info(yt_url, ope_mode, n_frags)
+    fmts = probe.get('requested_formats') or [probe]
     if ope_mode == "音声のみ":
-        return {
-            'format': 'bestaudio/best',
-            'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3'}],
-            'ffmpeg_location': "/usr/bin/ffmpeg"
-        }
+        need_convert = not native_audio
     else:
-        return {
-            'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-            'postprocessors': [{'key': 'FFmpegVideoConvertor', 'preferedformat': 'mp4'}],
-            'ffmpeg_location': "/usr/bin/ffmpeg"
-        }
+        # 選ばれたストリームが既にmp4(+m4a)ならコピーでの結合だけで済む
+        need_convert = not {f.get('ext') for f in fmts} <= {'mp4', 'm4a'}
+    yt = get_ydl(ope_mode, n_frags, need_convert)
+
+    # 見込みサイズを渡し、収まるならtmpfs上で作業する
+    size_hint = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in fmts)
+    temp_dir = get_download_dir(size_hint)
+
+    # ディレクトリ自体はセッション内で使い回し（mkdir/rmdirを繰り返さない）、
+    # ペイロードキャッシュのTTLが切れて参照されなくなったファイルだけを掃除する
+    cutoff = time.time() - _PAYLOAD_TTL
+    with os.scandir(temp_dir) as it:
+        for old in it:
+            if old.stat().st_mtime < cutoff:
+                os.unlink(old.path)
+
+    # 出力先だけはリクエストごとに切り替える
+    # （動画IDをファイル名に使い、同じディレクトリを使い回しても衝突しないようにする。
+    #   初期化済みインスタンスのouttmplは辞書に正規化されているのでdefaultキーを書き換える。
+    #   また、他セッションが同じインスタンスで別のディレクトリへ差し替えないよう、
+    #   差し替えからダウンロード完了までをロックで直列化する）
+    result = None
+    with yt.outtmpl_lock:
+        yt.params['outtmpl']['default'] = temp_dir + '/%(id)s.%(ext)s'
+        for attempt in range(_MAX_ATTEMPTS):
+            try:
+                # get_infoはキャッシュのコピーを返すため、試行ごとに未加工のinfoを渡せる
+                info = get_info(yt_url, ope_mode, n_frags)
+                result = _run_download(yt, info)
+                break
+            except Exception:
+                if attempt + 1 == _MAX_ATTEMPTS:
+                    raise
+                # 待ち時間にゆらぎを入れ、同一IP上の複数セッションが足並みを揃えて
+                # レート制限に突っ込むのを避ける
+                time.sleep(min(60, random.uniform(0.5, 1.5) * (2 ** attempt)))
+                _info(f"再試行します（{attempt + 2}/{_MAX_ATTEMPTS}回目）...")
+    # 後処理まで終わった実ファイルのパスはyt-dlpの返すinfoに入っているため、
+    # ディレクトリ走査をせずに確定的に取得できる
+    requested = (result or {}).get('requested_downloads') or []
+    if requested and requested[0].get('filepath'):
+        file_path = requested[0]['filepath']
+        return file_path, os.path.basename(file_path)
+    # 古いyt-dlpなどでパスが取れなかった場合だけディレクトリを走査する
+    with os.scandir(temp_dir) as it:
+        entry = next(it, None)
+    if entry is None:
+        raise FileNotFoundError("ダウンロードされたファイルが見つかりません。")
+    return entry.path, entry.name
+
+# 両モード共通のyt-dlpオプション（呼び出しごとに組み立て直さないようインポート時に一度だけ構築する）
+_COMMON_OPTIONS = {
+    'ffmpeg_location': "/usr/bin/ffmpeg",
+    # DASHのフラグメントを並列に取得して帯域を使い切る
+    'concurrent_fragment_downloads': 4,
+    # 1接続あたりのRangeリクエストを10MBに区切り、CDN側のスロットリングを受けにくくする
+    'http_chunk_size': 10 * 1024 * 1024,
+    # ファイルは一度使って捨てるだけなので、.part経由のリネームとmtime合わせの
+    # syscallは省略する
+    'nopart': True,
+    'updatetime': False,
+    'cachedir': _YTDLP_CACHE_DIR,
+    # 一時的な403/429で諦めないようリトライを厚めにする
+    # （スリープは指数バックオフで上限60秒に抑える）
+    'retries': 20,
+    'fragment_retries': 20,
+    'extractor_retries': 10,
+    'retry_sleep_functions': {
+        'http': lambda n: min(2 ** n, 60),
+        'fragment': lambda n: min(2 ** n, 60),
+    },
+    'progress_hooks': [_progress_hook],
+    # web_embeddedクライアントはPOトークン不要で、サイト側が要求する数秒のスリープも発生しない
+    'extractor_args': {'youtube': {'player_client': ['web_embedded']}},
+    'sleep_interval_requests': 0,
+    # Brotli対応を明示するとplayer JSやJSONがgzipより15-25%小さく届く
+    # （brotliパッケージが入っていればyt-dlp側で自動的に展開される）
+    'http_headers': {'Accept-Encoding': 'gzip, deflate, br'},
+    # HLS/DASHのフラグメント取得でTCP+TLS接続を使い回し、切断時は自動で再接続する
+    'external_downloader_args': {
+        'ffmpeg_i': [
+            '-http_persistent', '1',
+            '-multiple_requests', '1',
+            '-reconnect', '1',
+            '-reconnect_streamed', '1',
+            '-reconnect_delay_max', '5',
+        ],
+        # aria2cは1ファイルを16本のRange接続で並列取得する
+        # （事前のファイル領域確保は書き込み開始を遅らせるだけなので無効化する）
+        'aria2c': ['-x', '16', '-s', '16', '-k', '1M', '--file-allocation=none'],
+    },
+}
+if _ARIA2:
+    _COMMON_OPTIONS['external_downloader'] = 'aria2c'
+
+# モード固有のオプション（共通部分と同様にインポート時に構築して使い回す）
+_AUDIO_OPTIONS = {
+    'format': 'bestaudio/best',
+    'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3'}],
+    # mp3はCBRではなくVBR（-q:a 2）でエンコードする
+    # （同等品質でエンコードが速く、ファイルも小さくなる）
+    'postprocessor_args': {'extractaudio': ['-q:a', '2', '-threads', '0']},
+}
+_VIDEO_OPTIONS = {
+    'format': 'bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]/b',
+    'postprocessors': [{'key': 'FFmpegVideoConvertor', 'preferedformat': 'mp4'}],
+    # 変換は全コアで回し、moovアトムを先頭へ置いてダウンロードしながらの再生も可能にする
+    'postprocessor_args': {'videoconvertor': ['-threads', '0', '-movflags', '+faststart']},
+}
+
+# モードごとの完成済みテンプレート（共通部分とのマージもインポート時に1回だけ行う）
+_AUDIO_TEMPLATE = {**_COMMON_OPTIONS, **_AUDIO_OPTIONS}
+_VIDEO_TEMPLATE = {**_COMMON_OPTIONS, **_VIDEO_OPTIONS}
+
+# ダウンロードオプションを取得する関数
+# （浅いコピーを返すため、ネストした値はテンプレートと共有される。yt-dlp側は読み取り専用）
+def get_download_options(ope_mode):
+    return (_AUDIO_TEMPLATE if ope_mode == "音声のみ" else _VIDEO_TEMPLATE).copy()
 
 if __name__ == '__main__':
     main()